@@ -1,16 +1,14 @@
 import torch
 from dataclasses import dataclass
-from typing import List, Dict, Tuple, Optional
+from typing import List, Dict, Optional
 from datasets import load_dataset
 from transformers import AutoTokenizer, PreTrainedTokenizer
 from tiny_tokenizer import TinyTokenizer
 from torch.utils.data import DataLoader
+from torch.nn.utils.rnn import pad_sequence
 import functools
 import math
 
-KVCacheType = Tuple[torch.Tensor, torch.Tensor]
-BlocksKVCacheType = List[Optional[KVCacheType]]
-
 def get_gpt2_tokenizer() -> PreTrainedTokenizer:
     tokenizer = AutoTokenizer.from_pretrained("gpt2")
     tokenizer.add_special_tokens({'pad_token': '<PAD>'})
@@ -21,6 +19,7 @@ class GptConfig:
     """hyperparameters for GptLanguageModel"""
 
     batch_size: int = 64
+    grad_accum_steps: int = 4 # micro batches of batch_size per optimizer step
     block_size: int = 256
     max_steps: int = 300000
     learning_rate: float = 3.0e-3
@@ -30,6 +29,10 @@ class GptConfig:
     n_groups: int = 4
     n_layer: int = 12
     dropout: float = 0.2
+    mlp_ratio: float = 4 # mlp hidden width as a multiple of n_embd, 8 / 3 keeps modern GPT widths
+    activation: str = 'relu' # 'relu' or 'gelu' (tanh approximation)
+    norm: str = 'layer' # 'layer' or 'rms'
+    tie_weights: bool = False # share the token embeddings with lm_head
     seed: int = 42
     warmup_steps: int = .1 * max_steps 
     tokenizer: TinyTokenizer | PreTrainedTokenizer =  TinyTokenizer("tiny_tokenizer.json")
@@ -38,6 +41,17 @@ class GptConfig:
 
 hyperparameters = GptConfig()
 
+@dataclass
+class KVCache:
+    """preallocated key/value buffers for every layer, written in place while decoding"""
+
+    keys: torch.Tensor # [L, B, num_kv_heads, block_size, d]
+    values: torch.Tensor # [L, B, num_kv_heads, block_size, d]
+    length: int = 0 # number of positions already written, eager steps attend to this prefix of the cache
+    # device copy of length, once set steps attend to the whole cache with a mask so
+    # their shapes are static and the position advances on the device for cuda graph replay
+    pos: Optional[torch.Tensor] = None
+
 class TinyStoriesLoader:
 
     def __init__(self, config: GptConfig, split:str='train') -> None:
@@ -65,20 +79,18 @@ class TinyStoriesLoader:
             num_workers=num_workers,
             collate_fn=self.collate,
             drop_last=True,
-            batch_size=batch_size
+            batch_size=batch_size,
+            pin_memory=torch.cuda.is_available() # page-locked batches allow non-blocking copies to the gpu
         )
         self.iterator = iter(self.dataloader)
     
     def collate(self, batch: List[Dict[str, torch.Tensor]]) -> Dict[str, torch.Tensor]:
-        max_len = max(len(item['input_ids']) for item in batch)
-
-        # Pad to the right manually
-        padded_input_ids = [torch.cat([
-            item['input_ids'],
-            torch.full((max_len - len(item['input_ids']),), self.tokenizer.pad_token_id, dtype=torch.long)
-        ]) for item in batch]
-
-        input_ids = torch.stack(padded_input_ids)
+        # pad to the right and stack in a single call
+        input_ids = pad_sequence(
+            [item['input_ids'] for item in batch],
+            batch_first=True,
+            padding_value=self.tokenizer.pad_token_id
+        )
 
         return {
             'input_ids': input_ids
@@ -94,17 +106,62 @@ class TinyStoriesLoader:
             self.iterator = iter(self.dataloader)
             raise StopIteration
 
+class DevicePrefetcher:
+    """
+    wraps a loader and moves the next batch to the device on a side cuda stream while the current step runs
+    """
+
+    def __init__(self, loader: TinyStoriesLoader, device: str) -> None:
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream(device) if torch.device(device).type == 'cuda' else None
+        self.next_batch = None
+        self.preload()
+
+    def preload(self) -> None:
+        try:
+            batch = next(self.loader)
+        except StopIteration:
+            self.next_batch = None
+            return
+
+        if self.stream is None:
+            self.next_batch = {k: v.to(self.device) for k, v in batch.items()}
+            return
+
+        # the batches are pinned so the copy is asynchronous and overlaps with the compute stream
+        with torch.cuda.stream(self.stream):
+            self.next_batch = {k: v.to(self.device, non_blocking=True) for k, v in batch.items()}
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> Dict[str, torch.Tensor]:
+        if self.stream is not None:
+            torch.cuda.current_stream().wait_stream(self.stream)
+        batch = self.next_batch
+        if batch is None:
+            raise StopIteration
+
+        if self.stream is not None:
+            # the batch was allocated on the copy stream, keep its memory alive until the compute stream is done with it
+            for v in batch.values():
+                v.record_stream(torch.cuda.current_stream())
+        self.preload()
+        return batch
+
 def compute_perplexity (model: torch.nn.Module, dataset: TinyStoriesLoader): 
     model.eval()
-    total_loss = 0.0
+    # accumulated on the device so there is a single sync at the end rather than one per batch
+    total_loss = torch.zeros((), device=model.device)
     total_tokens = 0
-    with torch.no_grad():
+    with torch.inference_mode():
         for batch in dataset:
-            input_ids = batch['input_ids'].to(model.device)
+            input_ids = batch['input_ids'].to(model.device, non_blocking=True)
             xb, yb = input_ids[:, :-1], input_ids[:, 1:]
             _, loss, _ = model(xb, yb)
 
             total_loss += loss
             total_tokens += yb.numel()
 
-    return math.exp(total_loss / total_tokens)
\ No newline at end of file
+    return math.exp(total_loss.item() / total_tokens)
\ No newline at end of file
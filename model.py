@@ -1,9 +1,37 @@
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
+from torch.utils.checkpoint import checkpoint
 from einops import rearrange, einsum
-from typing import Tuple, Optional
-from common import GptConfig, BlocksKVCacheType
+from typing import Callable, Tuple, Optional
+from common import GptConfig, KVCache
+
+def rms_norm(x: torch.Tensor, weight: torch.Tensor, eps: float = 1e-6) -> torch.Tensor:
+    """
+    scales x by its root mean square, a single reduction instead of layer_norm's mean and variance
+    """
+    return x * torch.rsqrt(x.pow(2).mean(-1, keepdim=True) + eps) * weight
+
+def add_norm(x: torch.Tensor, residual: torch.Tensor, weight: torch.Tensor, rms: bool = False) -> torch.Tensor:
+    """
+    norm(x + residual), kept as one expression so a compiled model fuses the add and the norm into a single pass over x
+    """
+    x = x + residual
+    return rms_norm(x, weight) if rms else F.layer_norm(x, weight.shape, weight=weight)
+
+def chunked_cross_entropy(x: torch.Tensor, weight: torch.Tensor, targets: torch.Tensor, ignore_index: int, chunk_size: int = 1024) -> torch.Tensor:
+    """
+    summed cross entropy of the logits x @ weight against targets, computed over chunks of rows so
+    only one chunk of logits is alive at a time, each chunk's logits are recomputed for its backward
+    """
+    def chunk_loss(x_chunk: torch.Tensor, targets_chunk: torch.Tensor) -> torch.Tensor:
+        logits = x_chunk @ weight # [chunk_size, C] @ [C, vocab_size] -> [chunk_size, vocab_size]
+        return F.cross_entropy(logits, targets_chunk, ignore_index=ignore_index, reduction='sum')
+
+    return sum(
+        checkpoint(chunk_loss, x_chunk, targets_chunk, use_reentrant=False)
+        for x_chunk, targets_chunk in zip(x.split(chunk_size), targets.split(chunk_size))
+    )
 
 class GptLanguageModel (nn.Module):
 
@@ -12,6 +40,11 @@ class GptLanguageModel (nn.Module):
         for k, v in hyperparameters.__dict__.items():
             setattr(self, k, v)
 
+        if self.activation not in ('relu', 'gelu'):
+            raise ValueError(f"activation must be 'relu' or 'gelu', got {self.activation!r}")
+        if self.norm not in ('layer', 'rms'):
+            raise ValueError(f"norm must be 'layer' or 'rms', got {self.norm!r}")
+
         torch.manual_seed(self.seed)
 
         self.token_embedding_table = nn.Parameter(
@@ -20,144 +53,234 @@ class GptLanguageModel (nn.Module):
             torch.randn((self.block_size, self.n_embd)))
 
         # MLP projection matrices
+        self.mlp_hidden_dim = int(self.mlp_ratio * self.n_embd)
         self.fc_in = nn.Parameter(torch.randn(
-            (self.n_layer, self.n_embd, 4*self.n_embd)) / self.n_embd ** 0.5)
+            (self.n_layer, self.n_embd, self.mlp_hidden_dim)) / self.n_embd ** 0.5)
         self.fc_out = nn.Parameter(torch.randn(
-            (self.n_layer, 4*self.n_embd, self.n_embd)) / (4 * self.n_embd) ** 0.5)
+            (self.n_layer, self.mlp_hidden_dim, self.n_embd)) / self.mlp_hidden_dim ** 0.5)
 
         # projection matrices for attention
         self.head_dim = self.n_embd // self.n_head
         self.num_kv_heads = self.n_head // self.n_groups # h = g * num_kv_heads
         
-        self.q_proj = nn.Parameter(torch.randn(
-            (self.n_layer, self.n_embd, self.n_groups, self.num_kv_heads, self.head_dim)) / self.n_embd ** 0.5) # [L, C, g, num_kv_heads, d] 
-        
-        self.kv_proj =  nn.Parameter(torch.randn(
-            (self.n_layer, 2, self.n_embd, self.num_kv_heads, self.head_dim)) / self.n_embd ** 0.5) # [L, 2, C, num_kv_heads, d]
+        # fused projection for the queries (g slots), keys and values (the last 2 slots)
+        self.qkv_proj = nn.Parameter(torch.randn(
+            (self.n_layer, self.n_embd, self.n_groups + 2, self.num_kv_heads, self.head_dim)) / self.n_embd ** 0.5) # [L, C, g + 2, num_kv_heads, d]
         
         # mixes the head outputs 
         self.out_proj = nn.Parameter(torch.randn(
             (self.n_layer, self.n_embd, self.n_embd)) / (self.head_dim * self.n_head) ** 0.5)  # [L, C, C]
 
-        self.register_buffer('tril', torch.tril(
-            torch.ones(1, 1, self.block_size, self.block_size)))
-
-        self.lm_head = nn.Parameter(torch.randn(
-            (self.n_embd, self.vocab_size)) / self.n_embd ** 0.5)
+        if self.tie_weights:
+            # lm_head reuses the token embeddings, initialized small as in GPT-2 since they now also produce the logits,
+            # the position embeddings are scaled down with them so they don't drown out the token signal
+            nn.init.normal_(self.token_embedding_table, std=0.02)
+            nn.init.normal_(self.position_embedding_table, std=0.01)
+        else:
+            self.lm_head = nn.Parameter(torch.randn(
+                (self.n_embd, self.vocab_size)) / self.n_embd ** 0.5)
 
         self.scale = nn.Parameter(torch.ones(self.n_layer, 2, self.n_embd))
         
         self.out_scale = nn.Parameter(torch.ones(self.n_embd))
 
-    def forward(self, idx: torch.Tensor, targets: Optional[torch.Tensor] = None, blocks_kvcache: Optional[BlocksKVCacheType] = None) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[BlocksKVCacheType]]:
+    @property
+    def lm_head_weight(self) -> torch.Tensor:
         """
-        performs a forward pass of the model
+        the [C, vocab_size] output projection, a view of the token embeddings when the weights are tied
         """
+        return self.token_embedding_table.T if self.tie_weights else self.lm_head
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs) -> None:
+        """
+        converts checkpoints saved with separate q_proj and kv_proj to the fused qkv_proj
+        and drops the causal mask buffer they carry, masking is now done by sdpa
+        """
+        state_dict.pop(prefix + 'tril', None)
+        if prefix + 'q_proj' in state_dict:
+            q_proj = state_dict.pop(prefix + 'q_proj') # [L, C, g, num_kv_heads, d]
+            kv_proj = state_dict.pop(prefix + 'kv_proj') # [L, 2, C, num_kv_heads, d]
+            state_dict[prefix + 'qkv_proj'] = torch.cat(
+                [q_proj, rearrange(kv_proj, 'l s c kv_head d -> l c s kv_head d')], dim=2)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def forward(self, idx: torch.Tensor, targets: Optional[torch.Tensor] = None, kvcache: Optional[KVCache] = None) -> Tuple[Optional[torch.Tensor], Optional[torch.Tensor], Optional[KVCache]]:
+        """
+        performs a forward pass of the model, logits are only returned when no targets are given
+        """
         tok_emb = self.token_embedding_table[idx]
         B, T, C = tok_emb.shape
 
-        history_length = 0 if not blocks_kvcache or not blocks_kvcache[
-            0] else blocks_kvcache[0][0].shape[2]
-        pos_emb = self.position_embedding_table[torch.arange(
-            T, device=self.device) + history_length]
+        history_length = 0 if kvcache is None else kvcache.length
+        static_cache = kvcache is not None and kvcache.pos is not None
+        attn_mask = None
+        if static_cache:
+            # positions are read on the device so a decoding step never syncs with the host and can be captured in a cuda graph
+            positions = kvcache.pos + torch.arange(T, device=idx.device) # [T]
+            pos_emb = self.position_embedding_table[positions]
+            # attention runs over the whole cache, each query sees the cached keys up to its own position
+            attn_mask = torch.arange(self.block_size, device=idx.device) <= positions[:, None] # [T, block_size]
+        else:
+            # positions are contiguous so a slice is a view of the table, no index tensor or gather
+            pos_emb = self.position_embedding_table[history_length:history_length + T]
 
-        x = tok_emb + pos_emb  # [B, T, C]
-        for layer, (w_kv, w_q, w_out_proj, fc1, fc2, layer_scale) in enumerate(zip(self.kv_proj, self.q_proj, self.out_proj, self.fc_in, self.fc_out, self.scale)):
+        # every norm follows a residual add, the pending residual is carried into the next fused add + norm
+        x, residual = tok_emb, pos_emb  # [B, T, C]
+        for layer, (w_qkv, w_out_proj, fc1, fc2, layer_scale) in enumerate(zip(self.qkv_proj, self.out_proj, self.fc_in, self.fc_out, self.scale)):
 
-            x = F.layer_norm(x, (C,), weight=layer_scale[0])
+            x = add_norm(x, residual, layer_scale[0], rms=self.norm == 'rms')
 
-            q = einsum(x, w_q, 'b t c, c g kv_head d -> b g kv_head t d') # [B, g, num_kv_heads, T, d]
-            
-            # [B, T, C] @ [2, C, num_kv_heads, d] -> [2, B, T, num_kv_heads, d]
-            k, v = einsum(x, w_kv, 'b t c, s c kv_head d -> s b kv_head t d') # 2 [B, num_kv_heads, T, d]
-            # will reduce on C dimension
-
-            if blocks_kvcache:  # not None if we are using cache
-                kv_cache = blocks_kvcache[layer]
-                if kv_cache:
-                    prev_k, prev_v = kv_cache
-                    # [B, h, K, d] -> [B, h, K+T, d]
-                    k = torch.cat([prev_k, k], dim=2)
-                    v = torch.cat([prev_v, v], dim=2)
-
-                blocks_kvcache[layer] = [cache[:, :, -self.block_size:, :]  # [B, h, K, d]
-                                         for cache in (k, v)]  # truncate to conist of the last block_size tokens
-
-            # shape of k, v are [B, num_kv_heads, K, d] and for q it's [B, g, num_kv_heads, Q, d]
-            # compute qK^T for logits
-            att_wei = einsum(q, k, 'b g kv_head q d, b kv_head k d -> b g kv_head q k') * (self.head_dim ** -0.5)
-
-            # casual masking
-            att_wei = att_wei.masked_fill(
-                self.tril[:, :, :T, :T] == 0, float('-inf')
-            )
-            
-            att_wei = F.softmax(att_wei, dim=-1) # normalized attention logits
-            att_wei = F.dropout(att_wei, p=self.dropout,
-                                training=self.training)
+            # single projection for q, k and v, will reduce on C dimension
+            # [B, T, C] @ [C, g + 2, num_kv_heads, d] -> [g + 2, B, num_kv_heads, T, d]
+            qkv = einsum(x, w_qkv, 'b t c, c s kv_head d -> s b kv_head t d')
+            q = rearrange(qkv[:-2], 'g b kv_head t d -> b kv_head g t d') # [B, num_kv_heads, g, T, d]
+            k, v = qkv[-2], qkv[-1] # 2 [B, num_kv_heads, T, d]
+
+            if static_cache:
+                # write the new keys and values in place at their positions
+                kvcache.keys[layer].index_copy_(2, positions, k.to(kvcache.keys.dtype))
+                kvcache.values[layer].index_copy_(2, positions, v.to(kvcache.values.dtype))
+                # [B, num_kv_heads, K, d] where K = block_size, unwritten positions are masked out
+                k, v = kvcache.keys[layer], kvcache.values[layer]
+            elif kvcache is not None:  # not None if we are using cache
+                # write the new keys and values in place after the history
+                kvcache.keys[layer, :, :, history_length:history_length + T] = k
+                kvcache.values[layer, :, :, history_length:history_length + T] = v
+                # views over the written positions, [B, num_kv_heads, K, d] where K = history_length + T
+                k = kvcache.keys[layer, :, :, :history_length + T]
+                v = kvcache.values[layer, :, :, :history_length + T]
 
-            # [B, g, num_kv_heads, Q, K] @ [B, num_kv_heads, K, d] -> [B, g, num_kv_heads, Q, d]
-            out = einsum(att_wei, v, 'b g kv_head q k, b kv_head k d -> b g kv_head q d')
+            # fold the groups into the head dim, [B, num_kv_heads, g, Q, d] -> [B, h, Q, d]
+            # query head i reads kv head i // g so k, v stay [B, num_kv_heads, K, d] and are never copied per group
+            q = rearrange(q, 'b kv_head g q d -> b (kv_head g) q d')
+
+            # fused attention, never materializes the [Q, K] attention weights
+            out = F.scaled_dot_product_attention(
+                q, k, v,
+                attn_mask=attn_mask,
+                dropout_p=self.dropout if self.training else 0.0,
+                # a single decoded token attends to the whole prefix so only multi token steps need the causal mask
+                is_causal=attn_mask is None and T > 1,
+                enable_gqa=True
+            ) # [B, h, Q, d]
 
             # mixing the heads outputs amongst each other
-            # [B, g, num_kv_heads, Q, d] -> [B, Q, C]
-            out = rearrange(out, 'b g kv_head Q d -> b Q (g kv_head d)')
+            # [B, h, Q, d] -> [B, Q, C]
+            out = rearrange(out, 'b (kv_head g) Q d -> b Q (g kv_head d)', g=self.n_groups)
             # [B, Q, C] @ [C, C] -> [B, Q, C]
-            out = einsum(out, w_out_proj, 'b Q C1, C1 C2 -> b Q C2')
+            out = out @ w_out_proj
 
-            out = F.dropout(out, p=self.dropout, training=self.training)
+            if self.training and self.dropout > 0: # skip the dropout call entirely at eval and generation time
+                out = F.dropout(out, p=self.dropout)
 
-            x = x + out
-            x = F.layer_norm(x, [C], weight=layer_scale[1])
+            x = add_norm(x, out, layer_scale[1], rms=self.norm == 'rms')
             # switching back to referencing Q as T, so out = [B, T, C]
 
             # MLP block
-            # [B, T, C] @ [C, 4C] -> [B, T, 4C]
-            mlp_hidden = einsum(x, fc1, 'b t c, c upscale_c -> b t upscale_c')
-            mlp_hidden = F.relu(mlp_hidden)
-            # [B, T, 4C] @ [4C, C] -> [B, T, C]
-            mlp_out = einsum(mlp_hidden, fc2, 'b t c, c downscale_c -> b t downscale_c')
-            mlp_out = F.dropout(mlp_out, p=self.dropout, training=self.training)
+            # [B, T, C] @ [C, H] -> [B, T, H] where H = mlp_ratio * C
+            mlp_hidden = x @ fc1
+            # the tanh approximation is a pointwise expression that fuses into the matmul epilogue when compiled
+            mlp_hidden = F.gelu(mlp_hidden, approximate='tanh') if self.activation == 'gelu' else F.relu(mlp_hidden)
+            # [B, T, H] @ [H, C] -> [B, T, C]
+            mlp_out = mlp_hidden @ fc2
+            if self.training and self.dropout > 0:
+                mlp_out = F.dropout(mlp_out, p=self.dropout)
+
+            residual = mlp_out  # residual connection, added by the next norm
 
-            x = x + mlp_out  # residual connection
+        if static_cache:
+            kvcache.pos.add_(T) # in place so a captured graph advances it on every replay
+        elif kvcache is not None:
+            kvcache.length += T
 
-        x = F.layer_norm(x, [C], weight=self.out_scale)
+        x = add_norm(x, residual, self.out_scale, rms=self.norm == 'rms')
         
-        logits = einsum(x, self.lm_head, 'b t c, c v -> b t v')
-        loss = None
+        logits, loss = None, None
 
-        if targets is not None:
-            B, T, C = logits.shape
-            logits = rearrange(logits, 'b t c -> (b t) c')
+        if targets is None:
+            logits = x @ self.lm_head_weight # [B, T, C] @ [C, vocab_size] -> [B, T, vocab_size]
+        else:
+            # the [B * T, vocab_size] logits are never materialized, only a chunk of rows at a time
+            x = rearrange(x, 'b t c -> (b t) c')
             targets = rearrange(targets, 'b t -> (b t)')
-            loss = F.cross_entropy(logits, targets, reduction='none')
 
-            # zero out the loss for the padding tokens
-            padding_mask = (targets == self.tokenizer.pad_token_id)
-            loss = loss * ~padding_mask
-            loss = loss.sum() / (~padding_mask).sum()
+            # padding tokens are ignored by the loss and excluded from the mean
+            pad_token_id = self.tokenizer.pad_token_id
+            loss = chunked_cross_entropy(x, self.lm_head_weight, targets, ignore_index=pad_token_id)
+            loss = loss / (targets != pad_token_id).sum()
             
-        return logits, loss, blocks_kvcache
+        return logits, loss, kvcache
 
-    def generate(self, idx: str, max_new_tokens: int) -> str:
+    def capture_decode_step(self, kvcache: KVCache) -> Callable[[torch.Tensor], torch.Tensor]:
         """
-        generates a sequence of text
+        captures a single token decoding step into a cuda graph and returns a function that replays it,
+        the cache switches to attending over all of block_size with its position on the device so every step has the same shapes
         """
-        blocks_kvcache = [None] * self.n_layer
-        curr_idx = idx
-        for _ in range(max_new_tokens):
-            logits, loss, blocks_kvcache = self.forward(
-                curr_idx, blocks_kvcache=blocks_kvcache
-            )
-            logits = logits[:, -1, :]
-            probs = F.softmax(logits, dim=-1)
-        
-            # sanple top k
-            top_probs, top_indices = torch.topk(probs, self.top_k)
-            sample = torch.multinomial(top_probs, 1)
-            next_idx = top_indices[0, sample]
-            
-            curr_idx = next_idx
-            idx = torch.cat([idx, next_idx], dim=1)
-        return idx
+        B = kvcache.keys.shape[1]
+        static_idx = torch.zeros((B, 1), dtype=torch.long, device=kvcache.keys.device)
+        kvcache.pos = torch.tensor(kvcache.length, dtype=torch.long, device=kvcache.keys.device)
+        pos = kvcache.pos.clone()
+
+        # warm up on a side stream before capturing, it writes to the cache at the next position
+        # which the first replay overwrites as the position is restored afterwards
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            self.forward(static_idx, kvcache=kvcache)
+        torch.cuda.current_stream().wait_stream(stream)
+        kvcache.pos.copy_(pos)
+
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph):
+            static_logits, _, _ = self.forward(static_idx, kvcache=kvcache)
+
+        def decode_step(next_idx: torch.Tensor) -> torch.Tensor:
+            static_idx.copy_(next_idx)
+            graph.replay()
+            return static_logits # overwritten by the next replay
+
+        return decode_step
+
+    @torch.no_grad()
+    def generate(self, idx: str, max_new_tokens: int, cuda_graph: bool = True) -> str:
+        """
+        generates a sequence of text, on cuda the per token decoding step is replayed from a cuda graph unless cuda_graph is False
+        """
+        B, prompt_length = idx.shape
+        # every token but the last sampled one is fed back through the cache and needs a position embedding,
+        # checked up front as an out of range position inside a replayed cuda graph is a device side assert
+        cached_length = prompt_length + max(max_new_tokens - 1, 0)
+        if cached_length > self.block_size:
+            raise ValueError(
+                f"prompt_length + max_new_tokens - 1 = {cached_length} exceeds block_size = {self.block_size}")
+        # the cache holds at most block_size positions as that is all the position embeddings cover
+        cache_shape = (self.n_layer, B, self.num_kv_heads, self.block_size, self.head_dim)
+        kvcache = KVCache(
+            keys=torch.zeros(cache_shape, dtype=self.qkv_proj.dtype, device=idx.device),
+            values=torch.zeros(cache_shape, dtype=self.qkv_proj.dtype, device=idx.device),
+        )
+        # the whole output is allocated once and each sampled token is written in place
+        out = torch.empty((B, prompt_length + max_new_tokens), dtype=idx.dtype, device=idx.device)
+        out[:, :prompt_length] = idx
+
+        # the prompt is processed in one eager step, then one token at a time
+        logits, _, _ = self.forward(idx, kvcache=kvcache)
+        decode_step = None
+        for pos in range(prompt_length, prompt_length + max_new_tokens):
+            # sample from the top k with the gumbel-max trick, argmax(logits + gumbel noise) is a sample from
+            # softmax(logits) so there is no softmax or multinomial kernel
+            top_logits, top_indices = torch.topk(logits[:, -1, :], self.top_k) # 2 [B, top_k]
+            gumbel_noise = -torch.log(-torch.log(torch.empty_like(top_logits).uniform_()))
+            next_idx = top_indices.gather(-1, (top_logits + gumbel_noise).argmax(-1, keepdim=True)) # [B, 1]
+
+            out[:, pos] = next_idx.squeeze(-1)
+            if pos == prompt_length + max_new_tokens - 1:
+                break
+
+            if decode_step is None:
+                if cuda_graph and idx.device.type == 'cuda':
+                    decode_step = self.capture_decode_step(kvcache)
+                else:
+                    decode_step = lambda next_idx: self.forward(next_idx, kvcache=kvcache)[0]
+            logits = decode_step(next_idx)
+        return out
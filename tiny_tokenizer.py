@@ -4,6 +4,7 @@ from tokenizers.trainers import BpeTrainer
 from tokenizers.pre_tokenizers import Whitespace
 from datasets import load_dataset
 from typing import Any, List, Optional
+import numpy as np
 import torch
 
 class TinyTokenizer:
@@ -42,5 +43,7 @@ class TinyTokenizer:
             return self.encode(examples, add_special_tokens=add_special_tokens)
         if return_tensors != "pt":
             raise ValueError("Only return_tensors='pt' is supported")
-        tokenized_examples  = [self.encode(text, add_special_tokens=add_special_tokens) for text in examples]
-        return {"input_ids": torch.tensor(tokenized_examples)}
\ No newline at end of file
+        # encodes the whole batch in parallel in rust and builds the tensor from a single numpy array
+        encodings = self.tokenizer.encode_batch(examples, add_special_tokens=add_special_tokens)
+        tokenized_examples = np.array([encoding.ids for encoding in encodings], dtype=np.int64)
+        return {"input_ids": torch.from_numpy(tokenized_examples)}
\ No newline at end of file
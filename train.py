@@ -2,11 +2,12 @@ import torch
 from clearml import Task
 from datetime import datetime
 from torch.optim.lr_scheduler import CosineAnnealingLR
-from common import hyperparameters, TinyStoriesLoader
+from common import hyperparameters, TinyStoriesLoader, DevicePrefetcher
 from model import GptLanguageModel
 
 remote = True
 load_last_checkpoint = False
+compile_model = True
 
 if __name__ == "__main__":
 
@@ -21,7 +22,7 @@ if __name__ == "__main__":
 
     logger = task.get_logger()
     task.connect(vars(hyperparameters))
-    dataloader = TinyStoriesLoader(hyperparameters, split='train')
+    dataloader = DevicePrefetcher(TinyStoriesLoader(hyperparameters, split='train'), hyperparameters.device)
     einops_model = GptLanguageModel(hyperparameters)
 
     if load_last_checkpoint:
@@ -33,51 +34,63 @@ if __name__ == "__main__":
     m = einops_model.to(einops_model.device)
     tokenizer = m.tokenizer
 
+    if compile_model:
+        # batches are always [batch_size, block_size] so the graph is specialized on static shapes,
+        # max-autotune also captures the steady state forward/backward into cuda graphs
+        m = torch.compile(m, mode='max-autotune')
+
     # create a pytorch optimizer and scheduler
-    optimizer = torch.optim.AdamW(m.parameters(), lr=m.learning_rate)
+    # fused AdamW runs the whole parameter update as a single kernel, only supported on cuda
+    optimizer = torch.optim.AdamW(m.parameters(), lr=m.learning_rate, fused=m.device == 'cuda')
     scheduler = CosineAnnealingLR(optimizer, T_max=m.max_steps, eta_min=m.learning_rate * .1)
 
     epochs = 0
     for steps in range(m.max_steps):
-        try:
-            inputs = next(dataloader)
-        except StopIteration:
-            torch.save(m.state_dict(), f'model_intermediate_weights.pth')
-            epochs += 1
-            hyperparameters.seed += 1
-            dataloader = TinyStoriesLoader(hyperparameters, split='train')
-            inputs = next(dataloader)
-
-        xb, yb = inputs['input_ids'][:, :-1], inputs['input_ids'][:, 1:]
-
         # apply linear warm up for learning rate
         if steps < m.warmup_steps:
             lr_scale = min(1.0, float(steps + 1) / m.warmup_steps)
             for group in optimizer.param_groups:
                 group['lr'] = m.learning_rate * lr_scale
 
-        # evaluate the loss
-        logits, loss, _ = m(xb.to(m.device), yb.to(m.device))
+        # each optimizer step sees grad_accum_steps micro batches, their losses are summed on the device for logging
+        accum_loss = torch.zeros((), device=m.device)
+        for _ in range(m.grad_accum_steps):
+            try:
+                inputs = next(dataloader)
+            except StopIteration:
+                torch.save(einops_model.state_dict(), f'model_intermediate_weights.pth')
+                epochs += 1
+                hyperparameters.seed += 1
+                dataloader = DevicePrefetcher(TinyStoriesLoader(hyperparameters, split='train'), hyperparameters.device)
+                inputs = next(dataloader)
+
+            xb, yb = inputs['input_ids'][:, :-1], inputs['input_ids'][:, 1:]
+
+            # evaluate the loss, matmuls run in bfloat16 while autocast keeps the norms and loss in float32
+            with torch.autocast(device_type=m.device, dtype=torch.bfloat16):
+                logits, loss, _ = m(xb, yb)
+
+            # gradients accumulate across the micro batches, scaled so they average over the effective batch
+            (loss / m.grad_accum_steps).backward()
+            accum_loss += loss.detach()
         
         if steps % 100 == 0:  
             logger.report_scalar(title="Train Loss", series="Train Loss",
-                                value=loss.item(), iteration=steps)
+                                value=(accum_loss / m.grad_accum_steps).item(), iteration=steps)
             logger.report_scalar(title="Learning Rate", series="Learning Rate",
                                     value=optimizer.param_groups[0]['lr'], iteration=steps)
             logger.report_scalar(title="Epochs", series="Epochs",
                                     value=epochs, iteration=steps)
-        
-        optimizer.zero_grad(set_to_none=True)  # clear the gradients
 
-        loss.backward()  # compute gradients
         optimizer.step()  # update parameters
+        optimizer.zero_grad(set_to_none=True)  # clear the gradients
 
         # apply cosine decay for learning rate
         scheduler.step()
 
     print(loss.item())
 
-    torch.save(m.state_dict(), 'model_weights.pth')
+    torch.save(einops_model.state_dict(), 'model_weights.pth')
 
     start_str = "\n"
     curr_token = tokenizer.encode(start_str)